@@ -23,10 +23,116 @@ FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 DEALINGS IN THE SOFTWARE.
 """
 
-import json
+import asyncio
+import httpx
+import ipaddress
 import pytz
-import urllib3
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache
+from itertools import islice
+from typing import Iterator, Optional
+
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import maxminddb
+except ImportError:
+    maxminddb = None
+
+# Shared across lookups so connections and TLS sessions are kept alive,
+# with HTTP/2 multiplexing concurrent lookups over a single connection
+_CLIENT = httpx.Client(transport=httpx.HTTPTransport(
+    http2=True, retries=2, limits=httpx.Limits(max_connections=50, max_keepalive_connections=20)))
+
+# Responses keyed by the address they describe, with the time they were fetched,
+# least recently used first
+_CACHE: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+# Lookups run from threads too (fetch() and multithreaded callers)
+_CACHE_LOCK = threading.Lock()
+
+
+@lru_cache(maxsize=512)
+def _timezone(name: str) -> pytz.BaseTzInfo:
+    "Returns the pytz timezone of the name, built once per name"
+    return pytz.timezone(name)
+
+
+def _local_response(ip_address: str) -> Optional[dict]:
+    """
+    Validates the IP locally, returning the response ipinfo.io gives for
+    bogon addresses so that they never reach the network, or None for
+    addresses that have to be looked up
+    """
+    # Raises AddressValueError, a ValueError, for anything but an IPv4 address
+    address = ipaddress.IPv4Address(ip_address)
+    # Multicast is the one bogon range ipaddress counts as global
+    if not address.is_global or address.is_multicast:
+        return {"ip": ip_address, "bogon": True}
+    return None
+
+
+def _kvitems(chunks: Iterator[bytes]) -> Iterator[tuple[str, dict]]:
+    "Yields the top level pairs of a JSON object while its bytes are still arriving"
+    if ijson is None:
+        yield from _json.loads(b"".join(chunks)).items()
+        return
+    items = ijson.sendable_list()
+    parser = ijson.kvitems_coro(items, "", use_float=True)
+    for chunk in chunks:
+        parser.send(chunk)
+        yield from items
+        del items[:]
+    parser.close()
+    yield from items
+
+
+@lru_cache(maxsize=None)
+def _maxmind_reader(db_path: str) -> "maxminddb.Reader":
+    "Opens the MaxMind database once per path"
+    if maxminddb is None:
+        raise ImportError("The maxmind backend requires the maxminddb package")
+    return maxminddb.open_database(db_path)
+
+
+def _from_maxmind(ip_address: str, record: dict) -> dict:
+    "Maps a MaxMind city record onto the ipinfo.io response layout"
+    data = {"ip": ip_address}
+    if record is None:
+        return data
+    if "city" in record:
+        data["city"] = record["city"]["names"]["en"]
+    if "subdivisions" in record:
+        data["region"] = record["subdivisions"][0]["names"]["en"]
+    if "country" in record:
+        data["country"] = record["country"]["iso_code"]
+    location = record.get("location", {})
+    if "latitude" in location and "longitude" in location:
+        data["loc"] = f"{location['latitude']},{location['longitude']}"
+    if "time_zone" in location:
+        data["timezone"] = location["time_zone"]
+    if "postal" in record:
+        data["postal"] = record["postal"]["code"]
+    return data
+
+
+def _field(name: str, key: str) -> property:
+    "Builds a read-only property returning the key of the response"
+    def get(self: "IPv4info"):
+        self._ensure()
+        return self.all_data.get(key)
+    return property(get, doc=f"Returns the {name} of the IP")
+
 
 class IPv4info:
     """
@@ -36,88 +142,297 @@ class IPv4info:
     ----------
     ip_adress: str
         The IP address to get information
+    backend: str
+        Where to look the IP up, either "ipinfo" (the ipinfo.io API) or
+        "maxmind" (a local MaxMind database, no network access)
+    db_path: str
+        Path of the MaxMind database used by the "maxmind" backend
 
     Returns
     -------
     dict:
         Dictonary of all relevant information(s) of the IP address.
+
+    Attributes
+    ----------
+    hostname, ip, city, region, country, organization, postal: str
+        The hostname, IP address, city, region, country, organization and
+        postal code of the IP, None when unknown
+    bogon: bool
+        Whether the IP is a bogon address
     """
-    def __init__(self, ip_address: str = "json") -> None:
+    # Seconds a fetched response is reused before it is requested again
+    cache_ttl: float = 86400
+    # Number of responses kept, the least recently used ones are dropped first
+    cache_maxsize: int = 4096
+
+    # Read-only fields served straight from the response, attribute name to response key,
+    # turned into properties below the class
+    _FIELDS = {"hostname": "hostname", "ip": "ip", "city": "city", "region": "region",
+               "country": "country", "organization": "org", "postal": "postal", "bogon": "bogon"}
+
+    def __init__(self, ip_address: str = "json", backend: str = "ipinfo",
+                 db_path: str = "GeoLite2-City.mmdb") -> None:
         self.ip_address = ip_address
-        https = urllib3.PoolManager()
+        self.all_data = None
+        self._fetched = False
+        self._backend = backend
+        self._db_path = db_path
+        if backend not in ("ipinfo", "maxmind"):
+            raise ValueError(f"Unknown backend: {backend}")
+        if self.ip_address == "json":
+            if backend == "maxmind":
+                raise ValueError("The maxmind backend needs an explicit IP address")
+            return
+        # Validation and bogons are free, so they are not deferred like the lookup
+        local = _local_response(self.ip_address)
+        if local is not None:
+            self._load(local)
+
+    def _ensure(self) -> None:
+        "Looks the IP up on first use"
+        if not self._fetched:
+            self._fetch()
+
+    def _fetch(self) -> None:
+        "Looks the IP up from the cache, the MaxMind database or ipinfo.io"
+        if self._backend == "maxmind":
+            record = _maxmind_reader(self._db_path).get(self.ip_address)
+            self._load(_from_maxmind(self.ip_address, record))
+            return
+        # The caller's own address can change at any time, so it is never served from the cache
+        cached = self._cached(self.ip_address) if self.ip_address != "json" else None
+        if cached is not None:
+            self._load(cached)
+            return
         url = f'https://ipinfo.io/{self.ip_address}'
         try:
-            response = https.request('GET', url)
-            self.all_data = json.loads(response.data)
-            # Handling error
-            if "status" in self.all_data:
-                error = self.all_data["error"]
-                raise ValueError(f"{self.all_data["status"]} {error["title"]}: {error["message"]}")
+            response = _CLIENT.get(url)
+            self._raise_for_error(response)
+            self._load(_json.loads(response.content))
+            self._remember(self.ip_address, self.all_data)
         except Exception as e:
             raise e
-        
+
+    async def fetch(self) -> None:
+        "Looks the IP up without blocking the event loop"
+        # A thread on the shared client keeps its pooled connections, unlike a fresh AsyncClient
+        await asyncio.to_thread(self._ensure)
+
+    @classmethod
+    def _cached(cls, ip_address: str) -> Optional[dict]:
+        "Returns a copy of the cached response of the IP if it has not expired yet"
+        with _CACHE_LOCK:
+            entry = _CACHE.get(ip_address)
+            if entry is None:
+                return None
+            if time.time() - entry[0] >= cls.cache_ttl:
+                del _CACHE[ip_address]
+                return None
+            _CACHE.move_to_end(ip_address)
+        return dict(entry[1])
+
+    @classmethod
+    def _remember(cls, ip_address: str, data: dict) -> None:
+        """
+        Caches a successful response under the IP it describes, so that a
+        self lookup ("json") is never served for another network
+        """
+        now = time.time()
+        key = data.get("ip", ip_address)
+        # A copy, so that changes to an instance's all_data never leak into the cache
+        entry = (now, dict(data))
+        with _CACHE_LOCK:
+            _CACHE[key] = entry
+            _CACHE.move_to_end(key)
+            # Expired entries are dropped from the cold end, the rest once they are looked up
+            while _CACHE:
+                oldest = next(iter(_CACHE))
+                if now - _CACHE[oldest][0] < cls.cache_ttl and len(_CACHE) <= cls.cache_maxsize:
+                    break
+                del _CACHE[oldest]
+
+    @staticmethod
+    def clear_cache() -> None:
+        "Drops every cached response"
+        with _CACHE_LOCK:
+            _CACHE.clear()
+
+    @staticmethod
+    def _check(data: dict) -> None:
+        "Raises if ipinfo.io answered with an error"
+        if "status" in data:
+            error = data["error"]
+            raise ValueError(f"{data['status']} {error['title']}: {error['message']}")
+
+    @classmethod
+    def _raise_for_error(cls, response: httpx.Response) -> None:
+        "Raises if the request failed, with ipinfo.io's message when the body carries one"
+        if not response.is_error:
+            return
+        # Only a JSON body carries ipinfo.io's error message, anything else is left to httpx
+        try:
+            error = _json.loads(response.read())
+        except ValueError:
+            error = None
+        if isinstance(error, dict):
+            cls._check(error)
+        response.raise_for_status()
+
+    def _load(self, data: dict) -> None:
+        "Stores the data returned by ipinfo.io, raising on an API error"
+        self._check(data)
+        self.all_data = data
+        self._fetched = True
+        # Resolved once here so the properties below are plain attribute reads, a malformed
+        # loc or timezone only leaves that field unknown instead of failing the lookup
+        latitude, comma, longitude = data.get("loc", "").partition(",")
+        self._location = (latitude, longitude) if comma else None
+        self._timezone = data.get("timezone")
+        try:
+            self._tz = _timezone(self._timezone) if self._timezone is not None else None
+        except pytz.UnknownTimeZoneError:
+            self._tz = None
+
+    @classmethod
+    def _parse(cls, data: dict) -> "IPv4info":
+        "Builds an instance from already fetched data without touching the network"
+        self = cls.__new__(cls)
+        self.ip_address = data.get("ip")
+        self._load(data)
+        return self
+
+    @classmethod
+    async def prefetch_many(cls, objs: list["IPv4info"], concurrency: int = 64) -> None:
+        """
+        Looking up many not yet fetched instances concurrently, so that reading
+        their properties afterwards does not touch the network.
+
+        Parameters
+        ----------
+        objs: list[IPv4info]
+            The instances to look up, the same IP is only requested once
+        concurrency: int
+            Maximum number of requests in flight at once
+        """
+        pending = {}
+        for obj in objs:
+            if obj._fetched:
+                continue
+            if obj._backend != "ipinfo" or (obj.ip_address != "json"
+                                             and cls._cached(obj.ip_address) is not None):
+                obj._fetch()
+            else:
+                pending.setdefault(obj.ip_address, []).append(obj)
+        if not pending:
+            return
+        transport = httpx.AsyncHTTPTransport(http2=True, retries=2,
+                                             limits=httpx.Limits(max_connections=concurrency))
+        semaphore = asyncio.Semaphore(concurrency)
+        async with httpx.AsyncClient(transport=transport) as client:
+            async def one(ip: str, targets: list["IPv4info"]) -> None:
+                async with semaphore:
+                    response = await client.get(f'https://ipinfo.io/{ip}')
+                cls._raise_for_error(response)
+                data = _json.loads(response.content)
+                for obj in targets:
+                    obj._load(dict(data))
+                cls._remember(ip, data)
+            # Every lookup has to finish before the client is closed, even when one fails
+            results = await asyncio.gather(*(one(ip, targets) for ip, targets in pending.items()),
+                                           return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    @classmethod
+    async def from_many(cls, ips: list[str], concurrency: int = 64) -> list["IPv4info"]:
+        """
+        Retrieving detail information from many IPv4 addresses concurrently.
+
+        Parameters
+        ----------
+        ips: list[str]
+            The IP addresses to get information
+        concurrency: int
+            Maximum number of requests in flight at once
+
+        Returns
+        -------
+        list:
+            Instances in the same order as the given IP addresses.
+        """
+        objs = [cls(ip) for ip in ips]
+        await cls.prefetch_many(objs, concurrency)
+        return objs
+
+    @classmethod
+    def batch(cls, ips: list[str]) -> Iterator["IPv4info"]:
+        """
+        Retrieving detail information from many IPv4 addresses through the batch endpoint.
+
+        Parameters
+        ----------
+        ips: list[str]
+            The IP addresses to get information, sent 100 per request
+
+        Yields
+        ------
+        IPv4info:
+            One instance per distinct IP address, cached and bogon addresses
+            first, then the others in the order the response is parsed.
+        """
+        url = 'https://ipinfo.io/batch'
+        known, pending = [], []
+        for ip in dict.fromkeys(ips):
+            data = _local_response(ip) or cls._cached(ip)
+            if data is None:
+                pending.append(ip)
+            else:
+                known.append(data)
+        for data in known:
+            yield cls._parse(data)
+        pending = iter(pending)
+        while chunk := list(islice(pending, 100)):
+            with _CLIENT.stream('POST', url, content=_json.dumps(chunk),
+                                headers={"Content-Type": "application/json"}) as response:
+                cls._raise_for_error(response)
+                for ip, data in _kvitems(response.iter_bytes()):
+                    result = cls._parse(data)
+                    cls._remember(ip, data)
+                    yield result
+
     def __repr__(self):
+        # Never looks the IP up, as repr is used by debuggers and logging
+        if not self._fetched:
+            return f"<{type(self).__name__} {self.ip_address} (not fetched)>"
         return str(self.all_data)
         
     @property
     def all(self) -> str:
         "Returns all information as a dictionary"
+        self._ensure()
         return self.all_data
     
-    @property
-    def hostname(self) -> str:
-        "Returns the hostname associated with the IP"
-        return self.all_data["hostname"] if "hostname" in self.all_data else None
-
-    @property
-    def ip(self) -> str:
-        "Returns the IP address"
-        return self.all_data["ip"] if "ip" in self.all_data else None
-    
-    @property
-    def city(self) -> str:
-        "Returns the city of the IP belongs to"
-        return self.all_data["city"] if "city" in self.all_data else None
-    
-    @property
-    def region(self) -> str:
-        "Returns the region of the IP belongs to"
-        return self.all_data["region"] if "region" in self.all_data else None
-    
-    @property
-    def country(self) -> str:
-        "Returns the country of the IP belongs to"
-        return self.all_data["country"] if "country" in self.all_data else None
-        
     @property
     def location(self) -> tuple:
         "Returns the latitude and longitude information of the IP"
-        if "loc" in self.all_data:
-            latitude, longitude = self.all_data["loc"].split(",")[0], self.all_data["loc"].split(",")[1]
-            return (latitude, longitude)
-        return None
-    
-    @property
-    def organization(self) -> str:
-        "Returns the organization of the IP belongs to"
-        return self.all_data["org"] if "org" in self.all_data else None
-    
-    @property
-    def postal(self) -> str:
-        "Returns the postal code of the IP"
-        return self.all_data["postal"] if "postal" in self.all_data else None
+        self._ensure()
+        return self._location
     
     @property
     def time(self) -> datetime:
         "Returns the current UTC time of the IP"
-        return datetime.now(pytz.timezone(self.all_data["timezone"])) if "timezone" in self.all_data else None
+        self._ensure()
+        return datetime.now(self._tz) if self._tz is not None else None
 
     @property
     def timezone(self) -> str:
         "Returns the timezone of the IP"
-        return self.all_data["timezone"] if "timezone" in self.all_data else None
-    
-    @property
-    def bogon(self) -> bool:
-        "Checks if the IP is a bogon address"
-        return self.all_data["bogon"] if "bogon" in self.all_data else None
+        self._ensure()
+        return self._timezone
+
+
+for _name, _key in IPv4info._FIELDS.items():
+    setattr(IPv4info, _name, _field(_name, _key))
+del _name, _key
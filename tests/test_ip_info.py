@@ -1,9 +1,32 @@
+import asyncio
+import contextlib
+import httpx
+import json
 import pytest
-from src.ip_info import IPv4Info
+import time
+from concurrent.futures import ThreadPoolExecutor
+from src.ip_info import IPv4info, _CACHE, _CLIENT, _from_maxmind, _kvitems
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache():
+    saved = _CACHE.copy()
+    _CACHE.clear()
+    yield
+    _CACHE.clear()
+    _CACHE.update(saved)
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    "Fails any single lookup that would reach ipinfo.io"
+    def get(url):
+        raise AssertionError(f"unexpected request to {url}")
+    monkeypatch.setattr(_CLIENT, "get", get)
 
 
 def test_valid_ip():
-    ip_info = IPv4Info("8.8.8.8")
+    ip_info = IPv4info("8.8.8.8")
     assert ip_info.ip == "8.8.8.8"
     assert ip_info.city is not None
     assert ip_info.country is not None
@@ -11,4 +34,221 @@ def test_valid_ip():
 
 def test_invalid_ip():
     with pytest.raises(Exception):
-        IPv4Info("invalid_ip")
+        IPv4info("invalid_ip")
+
+
+def test_parsed_fields():
+    ip_info = IPv4info._parse({"ip": "8.8.8.8", "loc": "37.4056,-122.0775", "org": "AS15169 Google LLC",
+                               "timezone": "America/Los_Angeles"})
+    assert ip_info.ip == "8.8.8.8"
+    assert ip_info.location == ("37.4056", "-122.0775")
+    assert ip_info.organization == "AS15169 Google LLC"
+    assert ip_info.time.tzinfo is not None
+    assert ip_info.city is None
+    assert "city" in dir(ip_info)
+    with pytest.raises(AttributeError):
+        ip_info.city = "Mountain View"
+
+
+def test_unknown_timezone():
+    ip_info = IPv4info._parse({"ip": "8.8.8.8", "timezone": "Mars/Olympus", "city": "Mountain View"})
+    assert ip_info.time is None
+    assert ip_info.timezone == "Mars/Olympus"
+    assert ip_info.city == "Mountain View"
+
+
+def test_api_error():
+    with pytest.raises(ValueError):
+        IPv4info._parse({"status": 404, "error": {"title": "Wrong ip", "message": "Please provide a valid IP address"}})
+
+
+def test_maxmind_record():
+    record = {"city": {"names": {"en": "Tokyo"}}, "country": {"iso_code": "JP"},
+              "location": {"latitude": 35.6895, "longitude": 139.6917, "time_zone": "Asia/Tokyo"}}
+    ip_info = IPv4info._parse(_from_maxmind("1.1.1.1", record))
+    assert ip_info.city == "Tokyo"
+    assert ip_info.country == "JP"
+    assert ip_info.location == ("35.6895", "139.6917")
+    assert ip_info.timezone == "Asia/Tokyo"
+
+
+def test_maxmind_backend(monkeypatch, offline):
+    class Reader:
+        def get(self, ip_address):
+            return {"city": {"names": {"en": "Tokyo"}}, "country": {"iso_code": "JP"}}
+    paths = []
+    monkeypatch.setattr("src.ip_info._maxmind_reader", lambda db_path: paths.append(db_path) or Reader())
+    ip_info = IPv4info("1.1.1.1", backend="maxmind", db_path="City.mmdb")
+    assert ip_info.city == "Tokyo"
+    assert ip_info.country == "JP"
+    assert paths == ["City.mmdb"]
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        IPv4info("8.8.8.8", backend="ip2location")
+
+
+def test_maxmind_self_lookup():
+    with pytest.raises(ValueError):
+        IPv4info(backend="maxmind")
+
+
+def test_bogon_ip(offline):
+    ip_info = IPv4info("192.168.0.1")
+    assert ip_info.bogon is True
+    assert ip_info.city is None
+    assert IPv4info("100.64.0.1").bogon is True
+
+
+def test_lazy_lookup(offline):
+    _CACHE["8.8.8.8"] = (time.time(), {"ip": "8.8.8.8", "city": "Mountain View"})
+    ip_info = IPv4info("8.8.8.8")
+    assert ip_info.all_data is None
+    assert repr(ip_info) == "<IPv4info 8.8.8.8 (not fetched)>"
+    assert ip_info.city == "Mountain View"
+    assert ip_info.all_data is not None
+
+
+def test_fetch(offline):
+    _CACHE["8.8.8.8"] = (time.time(), {"ip": "8.8.8.8", "city": "Mountain View"})
+    ip_info = IPv4info("8.8.8.8")
+    asyncio.run(ip_info.fetch())
+    assert ip_info.all_data == {"ip": "8.8.8.8", "city": "Mountain View"}
+
+
+def test_rate_limited(monkeypatch):
+    monkeypatch.setattr(_CLIENT, "get", lambda url: httpx.Response(
+        429, text="Rate limit exceeded", request=httpx.Request("GET", url)))
+    with pytest.raises(httpx.HTTPStatusError):
+        IPv4info("8.8.8.8").city
+
+
+def test_prefetch_many(monkeypatch):
+    requested = []
+
+    async def get(client, url):
+        requested.append(url)
+        if url.endswith("9.9.9.9"):
+            return httpx.Response(429, text="Rate limit exceeded", request=httpx.Request("GET", url))
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json={"ip": url.rsplit("/", 1)[1]})
+    monkeypatch.setattr(httpx.AsyncClient, "get", get)
+    objs = [IPv4info(ip) for ip in ("8.8.8.8", "9.9.9.9", "8.8.8.8", "1.1.1.1")]
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(IPv4info.prefetch_many(objs))
+    assert sorted(requested) == ["https://ipinfo.io/1.1.1.1", "https://ipinfo.io/8.8.8.8", "https://ipinfo.io/9.9.9.9"]
+    assert [obj.all_data for obj in objs] == [{"ip": "8.8.8.8"}, None, {"ip": "8.8.8.8"}, {"ip": "1.1.1.1"}]
+
+
+def test_from_many(offline):
+    _CACHE["8.8.8.8"] = (time.time(), {"ip": "8.8.8.8", "city": "Mountain View"})
+    _CACHE["1.1.1.1"] = (time.time(), {"ip": "1.1.1.1", "city": "Brisbane"})
+    results = asyncio.run(IPv4info.from_many(["1.1.1.1", "10.0.0.1", "8.8.8.8", "1.1.1.1"]))
+    assert [ip_info.ip for ip_info in results] == ["1.1.1.1", "10.0.0.1", "8.8.8.8", "1.1.1.1"]
+    assert [ip_info.city for ip_info in results] == ["Brisbane", None, "Mountain View", "Brisbane"]
+    assert results[1].bogon is True
+
+
+def test_batch_bogons():
+    results = list(IPv4info.batch(["10.0.0.1", "127.0.0.1", "10.0.0.1"]))
+    assert [ip_info.ip for ip_info in results] == ["10.0.0.1", "127.0.0.1"]
+    assert all(ip_info.bogon for ip_info in results)
+
+
+def test_cache_hit(offline):
+    _CACHE["8.8.8.8"] = (time.time(), {"ip": "8.8.8.8", "city": "Mountain View"})
+    assert IPv4info("8.8.8.8").city == "Mountain View"
+
+
+def test_cache_expiry(monkeypatch):
+    _CACHE["8.8.8.8"] = (time.time() - IPv4info.cache_ttl - 1, {"ip": "8.8.8.8", "city": "Stale"})
+    monkeypatch.setattr(_CLIENT, "get", lambda url: httpx.Response(200, json={"ip": "8.8.8.8", "city": "Fresh"}))
+    assert IPv4info("8.8.8.8").city == "Fresh"
+    assert _CACHE["8.8.8.8"][1]["city"] == "Fresh"
+
+
+def test_cache_maxsize(monkeypatch):
+    monkeypatch.setattr(IPv4info, "cache_maxsize", 2)
+    for ip in ("1.1.1.1", "8.8.8.8", "9.9.9.9"):
+        IPv4info._remember(ip, {"ip": ip})
+    assert list(_CACHE) == ["8.8.8.8", "9.9.9.9"]
+
+
+def test_self_lookup_not_cached(monkeypatch):
+    monkeypatch.setattr(_CLIENT, "get", lambda url: httpx.Response(200, json={"ip": "8.8.8.8"}))
+    assert IPv4info().ip == "8.8.8.8"
+    assert "json" not in _CACHE
+    assert "8.8.8.8" in _CACHE
+
+
+def test_cache_isolated_from_instances(offline):
+    _CACHE["8.8.8.8"] = (time.time(), {"ip": "8.8.8.8", "city": "Mountain View"})
+    IPv4info("8.8.8.8").all["city"] = "Elsewhere"
+    assert IPv4info("8.8.8.8").city == "Mountain View"
+
+
+def test_cache_threads(monkeypatch):
+    monkeypatch.setattr(IPv4info, "cache_maxsize", 8)
+    ips = [f"8.8.{i}.{j}" for i in range(4) for j in range(64)]
+
+    def work():
+        for ip in ips:
+            IPv4info._remember(ip, {"ip": ip})
+            IPv4info._cached(ips[0])
+    with ThreadPoolExecutor(4) as executor:
+        futures = [executor.submit(work) for _ in range(4)]
+    for future in futures:
+        future.result()
+    assert len(_CACHE) <= 8
+
+
+def test_clear_cache():
+    _CACHE["8.8.8.8"] = (time.time(), {"ip": "8.8.8.8"})
+    IPv4info.clear_cache()
+    assert not _CACHE
+
+
+def test_malformed_location():
+    ip_info = IPv4info._parse({"ip": "8.8.8.8", "loc": "", "city": "Mountain View"})
+    assert ip_info.location is None
+    assert ip_info.city == "Mountain View"
+
+
+def test_batch(monkeypatch):
+    posted = []
+
+    @contextlib.contextmanager
+    def stream(method, url, content, **kwargs):
+        posted.append(json.loads(content))
+        body = json.dumps({"8.8.8.8": {"ip": "8.8.8.8", "city": "Mountain View", "loc": "37.4056,-122.0775"},
+                           "1.1.1.1": {"ip": "1.1.1.1", "city": "Brisbane"}}).encode()
+        yield httpx.Response(200, content=body, request=httpx.Request(method, url))
+    monkeypatch.setattr(_CLIENT, "stream", stream)
+    results = list(IPv4info.batch(["10.0.0.1", "8.8.8.8", "1.1.1.1", "8.8.8.8"]))
+    assert posted == [["8.8.8.8", "1.1.1.1"]]
+    assert [ip_info.ip for ip_info in results] == ["10.0.0.1", "8.8.8.8", "1.1.1.1"]
+    assert results[1].city == "Mountain View"
+    assert results[1].location == ("37.4056", "-122.0775")
+    assert IPv4info._cached("1.1.1.1") == {"ip": "1.1.1.1", "city": "Brisbane"}
+
+
+def test_batch_http_error(monkeypatch):
+    @contextlib.contextmanager
+    def stream(method, url, **kwargs):
+        yield httpx.Response(502, content=b"<html>Bad Gateway</html>", request=httpx.Request(method, url))
+    monkeypatch.setattr(_CLIENT, "stream", stream)
+    with pytest.raises(httpx.HTTPStatusError):
+        list(IPv4info.batch(["8.8.8.8"]))
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_kvitems(monkeypatch, streaming):
+    if streaming:
+        pytest.importorskip("ijson")
+    else:
+        monkeypatch.setattr("src.ip_info.ijson", None)
+    body = b'{"8.8.8.8": {"ip": "8.8.8.8", "score": 0.25}, "1.1.1.1": {"ip": "1.1.1.1", "bogon": true}}'
+    items = list(_kvitems(body[i:i + 7] for i in range(0, len(body), 7)))
+    assert items == [("8.8.8.8", {"ip": "8.8.8.8", "score": 0.25}), ("1.1.1.1", {"ip": "1.1.1.1", "bogon": True})]
+    assert type(items[0][1]["score"]) is float